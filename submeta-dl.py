@@ -1,35 +1,115 @@
-import json
+import ijson
+import orjson
+import aiohttp
+from yarl import URL
+import asyncio
 import yt_dlp
 import requests
-from bs4 import BeautifulSoup
+import re
 import sys
 import os
 import logging
 from tqdm import tqdm
 from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestException
 import getpass
+import pickle
 import time
+import random
+from email.utils import parsedate_to_datetime
+import threading
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 # Configure logging
 logging.basicConfig(filename='downloader.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Constants
-MAX_RETRIES = 3
-BACKOFF_FACTOR = 0.3
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1.0
+BACKOFF_JITTER = 0.5  # Random extra delay so parallel retries don't line up
+BACKOFF_MAX = 30  # seconds
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
 REQUEST_TIMEOUT = 10  # seconds
 CHUNK_SIZE = 1024  # For large downloads
+MAX_WORKERS = 4  # Videos downloaded in parallel
+# Added to yt-dlp's own aria2c defaults (-c -x16 -s16 --file-allocation=none ...)
+ARIA2C_ARGS = ['-k1M', '--max-tries=5', '--retry-wait=5']
+TOKEN_CONNECTIONS = 32  # Concurrent video auth requests
+BATCH_SIZE = 50  # Videos authorized per batched GraphQL request
+AUTH_WINDOW = 2 * MAX_WORKERS  # Videos authorized ahead of the download pool
+API_URL = "https://b.submeta.io/api"
+STREAM_URL_PREFIX = "https://customer-3j2pofw9vdbl9sfy.cloudflarestream.com/"
+STREAM_URL_SUFFIX = "/manifest/video.mpd"
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.aria2')  # Left behind by interrupted downloads
+CACHE_DIR = os.path.expanduser('~/.cache/submeta-dl')
+TOKEN_CACHE = os.path.join(CACHE_DIR, 'token.json')
+COOKIE_CACHE = os.path.join(CACHE_DIR, 'cookies.pkl')
+TOKEN_MAX_AGE = 23 * 60 * 60  # seconds
+JSON_SCRIPT_RE = re.compile(rb'<script[^>]*type="application/json"[^>]*>(.*?)</script>', re.DOTALL)
+
+YDL_OPTS = {
+    'extract_flat': 'discard_in_playlist',
+    'fragment_retries': 10,
+    'http_headers': {'Referer': 'https://submeta.io'},
+    'external_downloader': 'aria2c',
+    'external_downloader_args': {'aria2c': ARIA2C_ARGS},
+    'retries': 10,
+    'quiet': True
+}
+
+# YoutubeDL instances aren't thread safe, so each download thread keeps its own
+_thread_local = threading.local()
+_ydl_instances = []
+
+GET_VIDEO_QUERY = """
+query GetVideoForWatchAuth($id: ID!, $isStandalone: Boolean) {
+  result: getVideoForWatchAuth(id: $id, isStandalone: $isStandalone) {
+    video {
+      ...VideoForWatchAuthData
+      __typename
+    }
+    isAuthorized
+    errors {
+      ...ErrorsFields
+      __typename
+    }
+    __typename
+  }
+}
+fragment VideoForWatchAuthData on Video {
+  id
+  videoRef
+  token
+  __typename
+}
+fragment ErrorsFields on ErrorOutput {
+  key
+  message
+  __typename
+}
+"""
+
+# Serialized once; the "__ID__" placeholder is swapped for each video's id
+PAYLOAD_TEMPLATE = orjson.dumps({
+    "operationName": "GetVideoForWatchAuth",
+    "variables": {"id": "__ID__", "isStandalone": False},
+    "query": GET_VIDEO_QUERY
+})
 
 
 def create_session():
-    """Creates a requests session with retry logic and backoff."""
+    """Creates a requests session with retry logic and jittered backoff."""
     session = requests.Session()
     retries = Retry(
         total=MAX_RETRIES,
         backoff_factor=BACKOFF_FACTOR,
-        status_forcelist=[429, 500, 502, 503, 504],
+        backoff_jitter=BACKOFF_JITTER,
+        backoff_max=BACKOFF_MAX,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(['GET', 'POST']),
     )
     adapter = HTTPAdapter(max_retries=retries)
     session.mount("http://", adapter)
@@ -37,18 +117,17 @@ def create_session():
     return session
 
 
-def get_json(url, session):
+def get_page_data(url, session):
+    """Return the raw bytes of the page's application/json script blob."""
     headers = {
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0"
     }
     try:
         with session.get(url, headers=headers, timeout=REQUEST_TIMEOUT) as response:
             response.raise_for_status()
-            soup = BeautifulSoup(response.content, "html.parser")
-            data = soup.find(type="application/json")
-            if data:
-                for child in data.children:
-                    return json.loads(child.string)
+            match = JSON_SCRIPT_RE.search(response.content)
+            if match:
+                return match.group(1)
             logging.error(f"No JSON data found at URL: {url}")
     except (HTTPError, ConnectionError, Timeout) as e:
         logging.error(f"Network error while retrieving JSON from {url}: {e}")
@@ -57,18 +136,21 @@ def get_json(url, session):
     return None
 
 
-def get_course(json_data):
+def get_course(page_data):
+    """Return the chapter titles and a flat list of (chapter_index, video_index, video_title, video_id) records."""
     try:
-        course = {}
-        chapters = json_data['props']['pageProps']['course']['chapters']
-        for chapter in chapters:
-            chapter_title = sanitize_filename(chapter['title'])
-            course[chapter_title] = {}
-            for video in chapter['contents']:
-                if video['__typename'] == 'Video':
-                    video_title = sanitize_filename(video['title'])
-                    course[chapter_title][video_title] = video['id']
-        return course
+        chapters = []
+        videos = []
+        course_chapters = ijson.items(page_data, 'props.pageProps.course.chapters.item')
+        for chapter_index, chapter in enumerate(course_chapters, 1):
+            chapters.append(sanitize_filename(chapter['title']))
+            chapter_videos = [video for video in chapter['contents'] if video['__typename'] == 'Video']
+            for video_index, video in enumerate(chapter_videos, 1):
+                video_title = sanitize_filename(video['title'])
+                videos.append((chapter_index, video_index, video_title, video['id']))
+        if chapters:
+            return chapters, videos
+        logging.error("No chapters found in course JSON")
     except KeyError as e:
         logging.error(f"KeyError while parsing course JSON: {e}")
     except Exception as e:
@@ -76,21 +158,32 @@ def get_course(json_data):
     return None
 
 
+class _SanitizeTable(dict):
+    """Translation table that maps disallowed characters to '_' on first lookup."""
+
+    def __missing__(self, codepoint):
+        c = chr(codepoint)
+        value = c if c.isalnum() or c in (' ', '.', '_') else '_'
+        self[codepoint] = value
+        return value
+
+
+_SANITIZE_TABLE = _SanitizeTable()
+
+
 def sanitize_filename(filename):
     """Sanitize filenames by replacing special characters."""
-    return "".join([c if c.isalnum() or c in (' ', '.', '_') else '_' for c in filename])
+    return filename.translate(_SANITIZE_TABLE)
 
 
 def get_token(username, password, session):
     """Authenticate and get token from the submeta.io API."""
-    url = "https://b.submeta.io/api"
     headers = {
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0",
         "Content-Type": "application/json",
         "Accept": "*/*",
         "Origin": "https://submeta.io",
-        "Referer": "https://submeta.io/",
-        "Accept-Encoding": "gzip, deflate, br"
+        "Referer": "https://submeta.io/"
     }
 
     payload = {
@@ -121,9 +214,9 @@ def get_token(username, password, session):
     }
 
     try:
-        with session.post(url, headers=headers, data=json.dumps(payload), timeout=REQUEST_TIMEOUT) as response:
+        with session.post(API_URL, headers=headers, data=orjson.dumps(payload), timeout=REQUEST_TIMEOUT) as response:
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             token = data["data"]["login"].get("token")
             if token:
                 logging.info("Login successful!")
@@ -137,88 +230,297 @@ def get_token(username, password, session):
     return None
 
 
-def downloader(course, args, token, session):
-    url_prefix = "https://customer-3j2pofw9vdbl9sfy.cloudflarestream.com/"
-    url_suffix = "/manifest/video.mpd"
-    url_api = "https://b.submeta.io/api"
+def load_cached_token(session):
+    """Restore saved cookies and return the cached token if it is still fresh."""
+    try:
+        with open(COOKIE_CACHE, 'rb') as f:
+            session.cookies.update(pickle.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable cookie cache: {e}")
+
+    try:
+        with open(TOKEN_CACHE, 'rb') as f:
+            cached = orjson.loads(f.read())
+        if time.time() - cached['obtained'] < TOKEN_MAX_AGE:
+            logging.info("Using cached token")
+            return cached['token']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable token cache: {e}")
+    return None
+
+
+def _write_private(path, data):
+    """Write data to a file only the current user can read."""
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # The mode above only applies to new files, so tighten existing ones too
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+
+
+def save_token(token):
+    try:
+        _write_private(TOKEN_CACHE, orjson.dumps({"token": token, "obtained": time.time()}))
+    except OSError as e:
+        logging.warning(f"Failed to cache token: {e}")
+
+
+def save_cookies(session):
+    try:
+        _write_private(COOKIE_CACHE, pickle.dumps(session.cookies))
+    except OSError as e:
+        logging.warning(f"Failed to cache cookies: {e}")
+
+
+def clear_token_cache():
+    try:
+        os.remove(TOKEN_CACHE)
+    except FileNotFoundError:
+        pass
+
+
+def login(session):
+    """Prompt for credentials, log in and cache the resulting token."""
+    username = input("Enter username: ")
+    password = getpass.getpass("Enter password: ")  # Use getpass to hide password input
+    token = get_token(username, password, session)
+    if token:
+        save_token(token)
+        save_cookies(session)
+    return token
+
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying, honouring Retry-After like the urllib3 Retry config."""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return min(BACKOFF_MAX, BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, BACKOFF_JITTER))
+
+
+async def post_with_retry(client, payload, headers):
+    """POST to the API, retrying network errors and 429/5xx responses with jittered backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = await client.post(API_URL, data=payload, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(retry_delay(None, attempt))
+            continue
+        if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            # Read the body so the connection goes back to the pool
+            await response.read()
+            return response
+        response.release()
+        await asyncio.sleep(retry_delay(response, attempt))
+
+
+async def fetch_token(client, video_id, headers):
+    """Get the stream token for a single video."""
+    payload = PAYLOAD_TEMPLATE.replace(b'"__ID__"', orjson.dumps(video_id))
+    try:
+        response = await post_with_retry(client, payload, headers)
+        if response.status == 401:
+            raise PermissionError(f"Token rejected while authorizing video {video_id}")
+        response.raise_for_status()
+        data = orjson.loads(await response.read())
+        return data['data']['result']['video']['token']
+    except PermissionError:
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Network error while authorizing video {video_id}: {e}")
+    except Exception as e:
+        logging.error(f"Failed to authorize video {video_id}: {e}")
+    return None
+
+
+def build_batch_payload(video_ids):
+    """Build one GraphQL request that authorizes every video in video_ids through aliased fields."""
+    params = ', '.join(f'$id{i}: ID!' for i in range(len(video_ids)))
+    fields = ' '.join(f'v{i}: getVideoForWatchAuth(id: $id{i}, isStandalone: false) {{ video {{ token }} }}'
+                      for i in range(len(video_ids)))
+    return orjson.dumps({
+        "operationName": "BatchGetVideoForWatchAuth",
+        "variables": {f'id{i}': video_id for i, video_id in enumerate(video_ids)},
+        "query": f"query BatchGetVideoForWatchAuth({params}) {{ {fields} }}"
+    })
+
+
+async def fetch_batch(client, video_ids, headers):
+    """Get the stream tokens for several videos in one request.
+
+    Falls back to one request per video only when the server rejects the aliased query itself.
+    """
+    tokens = [None] * len(video_ids)
+    try:
+        response = await post_with_retry(client, build_batch_payload(video_ids), headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Network error while authorizing videos: {e}")
+        return tokens
+
+    if response.status == 401:
+        raise PermissionError("Token rejected while authorizing videos")
+    if response.status in RETRY_STATUSES:
+        # Still rate limited or failing after backoff; fanning out would only add load
+        logging.error(f"Batched video authorization failed with HTTP {response.status}")
+        return tokens
+
+    rejected = response.status >= 400
+    if not rejected:
+        try:
+            body = orjson.loads(await response.read())
+        except orjson.JSONDecodeError as e:
+            logging.error(f"Invalid response while authorizing videos: {e}")
+            return tokens
+        if not isinstance(body, dict):
+            logging.error(f"Unexpected response while authorizing videos: {body!r}")
+            return tokens
+        data = body.get('data')
+        rejected = data is None and bool(body.get('errors'))
+
+    if rejected:
+        logging.warning("Batched video authorization was rejected, retrying videos one by one")
+        return list(await asyncio.gather(*[fetch_token(client, video_id, headers) for video_id in video_ids]))
+
+    for i, video_id in enumerate(video_ids):
+        result = (data or {}).get(f'v{i}')
+        if result and result.get('video'):
+            tokens[i] = result['video'].get('token')
+        if not tokens[i]:
+            logging.error(f"Failed to authorize video {video_id}")
+    return tokens
+
+
+async def fetch_all_tokens(video_ids, token, session):
+    """Get the stream tokens for all videos in concurrent batches over one connection pool."""
     headers = {
         'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json',
         'Accept': '*/*',
+        'Accept-Encoding': 'gzip',
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0"
     }
+    connector = aiohttp.TCPConnector(limit=TOKEN_CONNECTIONS, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    cookies = session.cookies.get_dict()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+        # Seed against the API URL so the cookies are scoped to its domain rather than shared
+        client.cookie_jar.update_cookies(cookies, response_url=URL(API_URL))
+        batches = [video_ids[i:i + BATCH_SIZE] for i in range(0, len(video_ids), BATCH_SIZE)]
+        results = await asyncio.gather(*[fetch_batch(client, batch, headers) for batch in batches])
+        # Hand cookies set by the API back to the session so save_cookies persists them
+        for cookie in client.cookie_jar:
+            if cookie['domain'] and cookies.get(cookie.key) != cookie.value:
+                session.cookies.set(cookie.key, cookie.value, domain=cookie['domain'], path=cookie['path'] or '/')
+    return [video_token for batch in results for video_token in batch]
+
+
+def get_ydl():
+    """Return this worker thread's YoutubeDL instance, creating it on first use."""
+    ydl = getattr(_thread_local, 'ydl', None)
+    if ydl is None:
+        ydl = _thread_local.ydl = yt_dlp.YoutubeDL(dict(YDL_OPTS))
+        _ydl_instances.append(ydl)
+    return ydl
+
+
+def close_ydls():
+    """Close the YoutubeDL instances created by the download threads."""
+    # YoutubeDL.close() only exists from 2023.09.24, so use the context manager exit
+    while _ydl_instances:
+        _ydl_instances.pop().__exit__(None, None, None)
+
+
+def download_one(chapter_path, filename, video_token):
+    """Download a single video with yt-dlp."""
+    filepath = os.path.join(chapter_path, f'{filename}.%(ext)s')
+    download_url = f"{STREAM_URL_PREFIX}{video_token}{STREAM_URL_SUFFIX}"
 
+    try:
+        ydl = get_ydl()
+        ydl.params['outtmpl']['default'] = filepath
+        ydl.download([download_url])
+        logging.info(f"Successfully downloaded: {filename}")
+    except yt_dlp.utils.DownloadError as e:
+        logging.error(f"Failed to download {filename}: {e}")
+    except Exception as e:
+        logging.error(f"Failed to download {filename}: {e}")
+
+
+def downloader(course, args, token, session):
     download_path = args[2] if len(args) == 3 else 'submeta-downloads'
     os.makedirs(download_path, exist_ok=True)
 
-    for chapter in tqdm(course, desc="Chapters"):
-        chapter_index = list(course).index(chapter) + 1
-        chapter_title = sanitize_filename(chapter)
+    # Titles were already sanitized by get_course
+    chapters, videos = course
+    chapter_paths = {}
+    downloaded = set()
+    for chapter_index, chapter_title in enumerate(chapters, 1):
         chapter_path = os.path.join(download_path, f'{chapter_index}. {chapter_title}')
+        chapter_paths[chapter_index] = chapter_path
         os.makedirs(chapter_path, exist_ok=True)
+        for entry in os.scandir(chapter_path):
+            if not entry.name.endswith(PARTIAL_SUFFIXES):
+                downloaded.add((chapter_path, os.path.splitext(entry.name)[0]))
 
-        for video in tqdm(course[chapter], desc=f"Downloading videos from {chapter}", leave=False):
-            video_index = list(course[chapter]).index(video) + 1
-            video_title = sanitize_filename(video)
-            filename = f'{video_index}. {video_title}'
-            filepath = os.path.join(chapter_path, f'{filename}.%(ext)s')
-
-            payload = {
-                "operationName": "GetVideoForWatchAuth",
-                "variables": {"id": course[chapter][video], "isStandalone": False},
-                "query": """query GetVideoForWatchAuth($id: ID!, $isStandalone: Boolean) {
-                               result: getVideoForWatchAuth(id: $id, isStandalone: $isStandalone) {
-                                 video {
-                                   ...VideoForWatchAuthData
-                                   __typename
-                                 }
-                                 isAuthorized
-                                 errors {
-                                   ...ErrorsFields
-                                   __typename
-                                 }
-                                 __typename
-                               }
-                            }
-                            fragment VideoForWatchAuthData on Video {
-                              id
-                              videoRef
-                              token
-                              __typename
-                            }
-                            fragment ErrorsFields on ErrorOutput {
-                              key
-                              message
-                              __typename
-                            }
-                            """
-            }
+    # Skip finished videos before paying for their auth request
+    jobs = [(chapter_paths[chapter_index], f'{video_index}. {video_title}', video_id)
+            for chapter_index, video_index, video_title, video_id in videos]
+    pending = [job for job in jobs if job[:2] not in downloaded]
+    if len(pending) < len(jobs):
+        logging.info(f"Skipping {len(jobs) - len(pending)} already downloaded videos")
 
+    try:
+        return download_all(pending, token, session)
+    finally:
+        close_ydls()
+
+
+def download_all(pending, token, session):
+    """Authorize and download the pending videos, returning False if the token was rejected."""
+    # Downloads are network bound, so run several at once
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            tqdm(total=len(pending), desc="Downloading videos") as progress:
+        futures = set()
+        for start in range(0, len(pending), AUTH_WINDOW):
+            # Stream tokens are signed and expire, so only authorize the next window
+            # once the pool has nearly run out of queued downloads
+            while len(futures) > MAX_WORKERS:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update(1)
+
+            window = pending[start:start + AUTH_WINDOW]
             try:
-                with session.post(url_api, json=payload, headers=headers, timeout=REQUEST_TIMEOUT) as response:
-                    response.raise_for_status()
-                    data = response.json()
-                    video_token = data['data']['result']['video']['token']
-                    download_url = f"{url_prefix}{video_token}{url_suffix}"
-
-                    ydl_opts = {
-                        'extract_flat': 'discard_in_playlist',
-                        'fragment_retries': 10,
-                        'http_headers': {'Referer': 'https://submeta.io'},
-                        'external_downloader': 'aria2c',
-                        'ignoreerrors': True,
-                        'outtmpl': filepath,
-                        'retries': 10,
-                        'quiet': True
-                    }
-
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        ydl.download([download_url])
-                    logging.info(f"Successfully downloaded: {filename}")
-            except (HTTPError, ConnectionError, Timeout) as e:
-                logging.error(f"Network error while downloading {filename}: {e}")
-            except Exception as e:
-                logging.error(f"Failed to download {filename}: {e}")
+                video_tokens = asyncio.run(fetch_all_tokens([job[2] for job in window], token, session))
+            except PermissionError as e:
+                logging.error(f"{e}")
+                return False
+
+            for (chapter_path, filename, _), video_token in zip(window, video_tokens):
+                if video_token:
+                    futures.add(executor.submit(download_one, chapter_path, filename, video_token))
+                else:
+                    progress.update(1)
+
+        for future in as_completed(futures):
+            future.result()
+            progress.update(1)
+    return True
 
 
 def main(args):
@@ -228,24 +530,38 @@ def main(args):
 
     session = create_session()
 
-    json_data = get_json(args[1], session)
-    if not json_data:
+    page_data = get_page_data(args[1], session)
+    if not page_data:
         print("Failed to retrieve JSON data. Check the URL or logs for more information.")
         return -1
 
-    course = get_course(json_data)
+    course = get_course(page_data)
     if not course:
         print("Failed to parse course data. Check logs for more information.")
         return -1
 
-    username = input("Enter username: ")
-    password = getpass.getpass("Enter password: ")  # Use getpass to hide password input
-    token = get_token(username, password, session)
+    token = load_cached_token(session)
+    cached = token is not None
+    if not token:
+        token = login(session)
     if not token:
         print("Failed to login. Check credentials or logs for more information.")
         return -1
 
-    downloader(course, args, token, session)
+    authorized = downloader(course, args, token, session)
+    if not authorized and cached:
+        # The cached token expired early, so log in again once
+        clear_token_cache()
+        token = login(session)
+        if not token:
+            print("Failed to login. Check credentials or logs for more information.")
+            return -1
+        authorized = downloader(course, args, token, session)
+    if not authorized:
+        print("Token was rejected. Check logs for more information.")
+        return -1
+
+    save_cookies(session)
     print("Download complete!")
 
 